@@ -1,7 +1,11 @@
+import io
+import sys
+from collections import deque
+import hashlib
 import streamlit as st
 import pandas as pd
+import openpyxl
 import plotly.graph_objects as go
-import json
 
 # Page configuration
 st.set_page_config(
@@ -10,92 +14,264 @@ st.set_page_config(
     layout="wide"
 )
 
-# Initialize session state for expanded nodes
-if 'expanded_nodes' not in st.session_state:
-    st.session_state.expanded_nodes = set(["root"])
-if 'selected_node' not in st.session_state:
-    st.session_state.selected_node = None
+# Initialize session state
+if 'file_key' not in st.session_state:
+    st.session_state.file_key = None
 
-# Function to process Excel data
-def process_excel_data(file):
+# Function to stream paths from an opened workbook's active sheet
+def _workbook_paths(workbook):
     try:
-        df = pd.read_excel(file)
-        flat_paths = []
-        
-        for _, row in df.iterrows():
-            path_parts = [str(cell) for cell in row if pd.notna(cell) and str(cell).strip()]
+        for row in workbook.active.iter_rows(values_only=True):
+            path_parts = [str(cell) for cell in row if cell is not None and str(cell).strip()]
             if path_parts:
-                path = '/'.join(path_parts)
-                flat_paths.append(path)
+                yield '/'.join(path_parts)
+    finally:
+        workbook.close()
+
+# Function to stream paths from an .xlsx workbook without building a DataFrame.
+# The workbook is opened here, so a bad upload fails before streaming starts
+def _xlsx_paths(raw):
+    workbook = openpyxl.load_workbook(io.BytesIO(raw), read_only=True, data_only=True)
+    return _workbook_paths(workbook)
+
+# Function to flatten a DataFrame's rows into paths
+def _frame_paths(df):
+    # Keep cells as objects; a fixed-width string array pads every cell
+    # to the longest one
+    cells = df.to_numpy(dtype=object)
+    
+    # Mask out blank cells column by column (NaN compares False)
+    keep = df.apply(lambda column: column.str.strip().str.len() > 0).to_numpy(dtype=bool)
+    
+    # Arrays are built before returning, so only the joins are lazy
+    return ('/'.join(row[row_keep]) for row, row_keep in zip(cells, keep) if row_keep.any())
+
+# Function to fingerprint an upload, hashing its bytes once per file
+def get_file_key(file):
+    cached = st.session_state.file_key
+    if cached is None or cached[0] != file.file_id:
+        digest = hashlib.blake2b(file.getvalue(), digest_size=16).hexdigest()
+        st.session_state.file_key = cached = (file.file_id, digest)
+    return cached[1]
+
+# Function to process Excel data into a stream of folder paths
+def process_excel_data(raw):
+    try:
+        # The Rust-backed calamine engine reads both .xlsx and .xls
+        df = pd.read_excel(io.BytesIO(raw), engine="calamine", dtype=str, header=None)
+    except ImportError:
+        if raw[:4] == b"PK\x03\x04":
+            return _xlsx_paths(raw)
         
-        return flat_paths, None
-    except Exception as e:
-        return [], f"Error processing Excel file: {str(e)}"
+        # Legacy .xls cannot be read by openpyxl; let pandas pick the engine
+        df = pd.read_excel(io.BytesIO(raw), dtype=str, header=None)
+    
+    return _frame_paths(df)
 
-# Function to build folder hierarchy
+# Function to build folder hierarchy as a flat parent -> children map
 def build_folder_hierarchy(paths):
     try:
-        # Create a dictionary to represent the folder structure
-        folder_structure = {}
+        # Every folder is keyed by its full path id, starting from "root"
+        children_map = {"root": []}
+        labels_map = {"root": "Root"}
+        seen_paths = set()
         
         for path in paths:
-            parts = path.split('/')
-            current_level = folder_structure
+            # Skip repeated rows so each path is walked once
+            if path in seen_paths:
+                continue
+            seen_paths.add(path)
             
-            for i, part in enumerate(parts):
-                if part not in current_level:
-                    current_level[part] = {}
+            current_id = "root"
+            
+            for part in path.split('/'):
+                child_id = f"{current_id}/{part}"
+                
+                if child_id not in labels_map:
+                    # Intern ids and names so repeated strings share one object
+                    child_id = sys.intern(child_id)
+                    labels_map[child_id] = sys.intern(part)
+                    children_map[child_id] = []
+                    children_map[current_id].append(child_id)
                 
-                current_level = current_level[part]
+                current_id = child_id
         
-        return folder_structure, None
+        # Count the folders in each subtree (itself included). Ids are inserted
+        # after their parent, so a reverse pass sees children before parents
+        sizes_map = {}
+        for folder_id in reversed(children_map):
+            sizes_map[folder_id] = 1 + sum(sizes_map[child] for child in children_map[folder_id])
+        
+        return children_map, labels_map, sizes_map, None
+    except Exception as e:
+        return {}, {}, {}, f"Error building folder hierarchy: {str(e)}"
+
+# Function to load an upload's folder hierarchy, streaming paths from the
+# workbook straight into the builder (cached on the file fingerprint).
+# cache_resource hands back the same maps on every rerun instead of an
+# unpickled copy; callers only read them.
+@st.cache_resource(show_spinner=False, max_entries=8)
+def load_folder_hierarchy(file_key, _file):
+    try:
+        paths = process_excel_data(_file.getvalue())
     except Exception as e:
-        return {}, f"Error building folder hierarchy: {str(e)}"
-
-# Function to convert folder structure to plotly treemap data
-def create_treemap_data(folder_structure, parent="", level=0, path=""):
-    labels = []
-    parents = []
-    values = []
-    ids = []
-    
-    # Process each folder in the current level
-    for folder_name, subfolders in folder_structure.items():
-        # Create a unique ID for this folder
-        folder_id = f"{path}/{folder_name}" if path else folder_name
+        return {}, {}, {}, f"Error processing Excel file: {str(e)}"
+    
+    return build_folder_hierarchy(paths)
+
+# Function to convert folder hierarchy to plotly treemap data
+def create_treemap_data(children_map, labels_map, sizes_map, max_nodes=None, max_depth=None):
+    # Pre-size the output lists: at most every folder, capped by the budget
+    capacity = len(labels_map) if max_nodes is None else min(len(labels_map), max_nodes)
+    labels = [None] * capacity
+    parents = [None] * capacity
+    values = [None] * capacity
+    ids = [None] * capacity
+    
+    # Start with the root node so nothing has to be prepended later
+    labels[0] = labels_map["root"]
+    parents[0] = ""
+    values[0] = sizes_map["root"]
+    ids[0] = "root"
+    count = 1
+    
+    # Walk the hierarchy breadth-first so a node budget keeps the upper levels
+    top_folders = sorted(children_map.get("root", []), key=sizes_map.__getitem__, reverse=True)
+    queue = deque(("root", child, 1) for child in top_folders)
+    
+    # Queued folders per parent; each parent left in here at the end gets
+    # one "+N more" sector, so the budget keeps a slot for each of them
+    pending = {"root": len(top_folders)} if top_folders else {}
+    
+    while queue:
+        parent, folder_id, depth = queue[0]
+        
+        # Queue subfolders largest-first, so a node budget keeps the biggest
+        # subtrees, stopping one level below the displayed depth (maxdepth
+        # counts the root) so the treemap can still drill down a level
+        # without sending the rest
+        subfolders = children_map[folder_id] if max_depth is None or depth < max_depth else []
+        
+        # Stop once adding this folder would leave no room for the summaries
+        summaries = len(pending) - (pending[parent] == 1) + bool(subfolders)
+        if count + 1 + summaries > capacity:
+            break
+        
+        queue.popleft()
+        if pending[parent] == 1:
+            del pending[parent]
+        else:
+            pending[parent] -= 1
         
         # Add this folder to the data
-        labels.append(folder_name)
-        parents.append(parent)
-        values.append(1)  # All nodes have equal weight
-        ids.append(folder_id)
+        labels[count] = labels_map[folder_id]
+        parents[count] = parent
+        values[count] = sizes_map[folder_id]  # Sector area follows subtree size
+        ids[count] = folder_id
+        count += 1
         
-        # Process subfolders recursively
         if subfolders:
-            sub_labels, sub_parents, sub_values, sub_ids = create_treemap_data(
-                subfolders, folder_name, level + 1, folder_id
-            )
-            labels.extend(sub_labels)
-            parents.extend(sub_parents)
-            values.extend(sub_values)
-            ids.extend(sub_ids)
+            subfolders = sorted(subfolders, key=sizes_map.__getitem__, reverse=True)
+            queue.extend((folder_id, child, depth + 1) for child in subfolders)
+            pending[folder_id] = len(subfolders)
+    
+    shown = count
+    
+    # Fold whatever the node budget cut off into one "+N more" sector per
+    # parent, sized by the folders it stands for
+    hidden_sizes = {}
+    for parent, folder_id, _ in queue:
+        hidden_sizes[parent] = hidden_sizes.get(parent, 0) + sizes_map[folder_id]
     
-    return labels, parents, values, ids
+    for parent, hidden in pending.items():
+        labels[count] = f"+{hidden} more"
+        parents[count] = parent
+        values[count] = hidden_sizes[parent]
+        # Real ids all start with "root", so this prefix cannot collide
+        ids[count] = f"more:{parent}"
+        count += 1
+    
+    # Trim slots left unused by depth pruning
+    del labels[count:], parents[count:], values[count:], ids[count:]
+    
+    return labels, parents, values, ids, shown
+
+# Function to build the treemap figure and count the folders it shows,
+# cached per file and display options
+@st.cache_resource(show_spinner=False, max_entries=16)
+def get_treemap_figure(file_key, max_nodes, max_depth, _children_map, _labels_map, _sizes_map):
+    labels, parents, values, ids, shown = create_treemap_data(_children_map, _labels_map, _sizes_map,
+                                                              max_nodes, max_depth)
+    
+    fig = go.Figure(go.Treemap(
+        labels=labels,
+        parents=parents,
+        values=values,
+        ids=ids,
+        root_color="lightblue",
+        branchvalues="total",
+        maxdepth=max_depth,
+        marker=dict(
+            colors=['rgba(135, 206, 250, 0.8)'] * len(labels),
+            line=dict(width=2, color='white')
+        ),
+        textfont=dict(size=14),
+        hovertemplate='<b>%{label}</b><br>Path: %{id}<extra></extra>'
+    ))
+    
+    # Update layout
+    fig.update_layout(
+        margin=dict(t=30, l=10, r=10, b=10),
+        height=600,
+        width=800,
+        # Keep the user's drill-down across reruns of the same file
+        uirevision=file_key
+    )
+    
+    return fig, shown
 
 # Function to get direct children of a node
-def get_direct_children(folder_structure, node_id):
-    parts = node_id.split('/')
-    current = folder_structure
-    
-    # Navigate to the correct node
-    for part in parts:
-        if part in current:
-            current = current[part]
-        else:
-            return []
+def get_direct_children(children_map, node_id):
+    return children_map.get(node_id, [])
+
+# Function to render node selection and metadata as a fragment, so picking
+# a node reruns only this panel instead of the whole app
+@st.fragment
+def metadata_panel(hierarchy):
+    st.header("Metadata")
+    
+    if hierarchy is None:
+        st.info("Upload an Excel file to browse its folders")
+        return
+    
+    file_key, children_map, labels_map = hierarchy
+    
+    # Allow node selection one level at a time, listing only the
+    # children of the folder picked at the previous level
+    node_id = "root"
+    while children_map[node_id]:
+        child = st.selectbox(f"Select a node in {labels_map[node_id]}:",
+                             options=[None] + children_map[node_id],
+                             format_func=lambda x: labels_map.get(x, "—"),
+                             key=f"select_{file_key}_{node_id}")
+        # A kept selection may not exist in this file's hierarchy
+        if child is None or child not in children_map:
+            break
+        node_id = child
     
-    # Return direct children
-    return list(current.keys())
+    st.markdown("---")
+    st.markdown(f"### Selected Node: {labels_map[node_id]}")
+    st.markdown(f"**Path:** {node_id}")
+    
+    # Display direct children
+    children = get_direct_children(children_map, node_id)
+    
+    if children:
+        st.markdown("### Children:")
+        for child in children:
+            st.markdown(f"- {labels_map[child]}")
+    else:
+        st.markdown("This node has no children.")
 
 # Main application layout
 st.title("Interactive Folder Tree Visualization")
@@ -106,114 +282,56 @@ with st.sidebar:
     uploaded_file = st.file_uploader("Choose an Excel file", type=["xlsx", "xls"])
     
     st.header("Options")
-    max_depth = st.slider("Max Display Depth", min_value=1, max_value=10, value=3,
-                         help="Maximum depth of folders to display")
+    # Batch option changes so dragging a slider doesn't rebuild the view
+    with st.form("display_options"):
+        max_depth = st.slider("Max Display Depth", min_value=1, max_value=10, value=3,
+                             help="Maximum depth of folders to display")
+        max_nodes = st.slider("Max Nodes", min_value=200, max_value=10000, value=2000, step=100,
+                              help="Maximum number of folders sent to the treemap")
+        st.form_submit_button("Apply")
     
     # Reset button
     if st.button("Reset View"):
-        st.session_state.expanded_nodes = set(["root"])
-        st.session_state.selected_node = None
+        for key in [key for key in st.session_state if key.startswith("select_")]:
+            del st.session_state[key]
         st.rerun()
 
 # Main content area
 col1, col2 = st.columns([3, 1])
 
 with col1:
+    # Hierarchy of the current upload, shared with the metadata panel
+    hierarchy = None
+    
     if uploaded_file is not None:
-        # Process the Excel file
-        paths, error = process_excel_data(uploaded_file)
+        # Fingerprint the upload so derived data can be cached per file
+        file_key = get_file_key(uploaded_file)
+        
+        # Load the folder hierarchy
+        children_map, labels_map, sizes_map, error = load_folder_hierarchy(file_key, uploaded_file)
         
         if error:
             st.error(error)
-        elif not paths:
+        elif not children_map["root"]:
             st.warning("No valid folder paths found in the Excel file.")
         else:
-            # Build folder hierarchy
-            folder_structure, error = build_folder_hierarchy(paths)
+            hierarchy = (file_key, children_map, labels_map)
             
-            if error:
-                st.error(error)
-            else:
-                # Create treemap data
-                labels, parents, values, ids = create_treemap_data(folder_structure)
-                
-                # Add root node
-                labels.insert(0, "Root")
-                parents.insert(0, "")
-                values.insert(0, 1)
-                ids.insert(0, "root")
-                
-                # Create treemap figure
-                fig = go.Figure(go.Treemap(
-                    labels=labels,
-                    parents=parents,
-                    values=values,
-                    ids=ids,
-                    root_color="lightblue",
-                    branchvalues="total",
-                    maxdepth=max_depth,
-                    marker=dict(
-                        colors=['rgba(135, 206, 250, 0.8)'] * len(labels),
-                        line=dict(width=2, color='white')
-                    ),
-                    textfont=dict(size=14),
-                    hovertemplate='<b>%{label}</b><br>Path: %{id}<extra></extra>'
-                ))
-                
-                # Update layout
-                fig.update_layout(
-                    margin=dict(t=30, l=10, r=10, b=10),
-                    height=600,
-                    width=800
-                )
-                
-                # Display the treemap
-                st.plotly_chart(fig, use_container_width=True)
-                
-                # Add click handler for node selection
-                st.info("👆 Click on a node in the treemap to select it")
-                
-                # Allow node selection via selectbox
-                selected_node = st.selectbox("Select a node:", 
-                                           options=ids,
-                                           format_func=lambda x: x.split('/')[-1] if '/' in x else x)
-                
-                if selected_node:
-                    st.session_state.selected_node = selected_node
+            # Create treemap figure
+            fig, shown = get_treemap_figure(file_key, max_nodes, max_depth,
+                                            children_map, labels_map, sizes_map)
+            
+            if shown < len(labels_map):
+                st.caption(f"Showing {shown} of {len(labels_map)} folders "
+                           "(raise Max Display Depth or Max Nodes to include more)")
+            
+            # Display the treemap
+            st.plotly_chart(fig, use_container_width=True, key="folder_treemap")
+            
+            st.info("👉 Select a node in the Metadata panel to view its details")
     else:
         st.info("Upload an Excel file to visualize your folder structure")
 
 # Metadata panel
 with col2:
-    st.header("Metadata")
-    
-    if st.session_state.selected_node:
-        st.markdown("---")
-        node_id = st.session_state.selected_node
-        
-        # Get node label
-        node_label = node_id.split('/')[-1] if '/' in node_id else node_id
-        
-        st.markdown(f"### Selected Node: {node_label}")
-        st.markdown(f"**Path:** {node_id}")
-        
-        # Display children if available
-        if uploaded_file is not None:
-            try:
-                # Process the Excel file again to get the folder structure
-                paths, _ = process_excel_data(uploaded_file)
-                folder_structure, _ = build_folder_hierarchy(paths)
-                
-                # Get direct children
-                children = get_direct_children(folder_structure, node_id)
-                
-                if children:
-                    st.markdown("### Children:")
-                    for child in children:
-                        st.markdown(f"- {child}")
-                else:
-                    st.markdown("This node has no children.")
-            except Exception as e:
-                st.error(f"Error getting children: {str(e)}")
-    else:
-        st.info("Click on a node to view its details")
+    metadata_panel(hierarchy)